@@ -1,13 +1,23 @@
 
-from typing import NamedTuple, List, Iterator, Dict, Tuple
+from typing import NamedTuple, List, Iterator, Iterable, Dict, Tuple, Optional, Callable, Set, TypeVar
+from multiprocessing import Pool
 import tarfile
-import atexit
 import os
-import shutil
-import tempfile
+import re
+import sys
 
 from scispacy.file_cache import cached_path
 
+# Buffer size used when streaming the MedMentions archive. Reading in large
+# chunks means far fewer read syscalls and calls into the gzip decompressor
+# than tarfile's default 10KB buffer.
+_READ_BUFFER_SIZE = 2 * 1024 * 1024
+
+T = TypeVar("T") # pylint: disable=invalid-name
+
+# One or more lines which are empty, or contain only whitespace.
+_BLANK_LINES = re.compile(r"\n(?:[^\S\n]*\n)+")
+
 class MedMentionEntity(NamedTuple):
     start: int
     end: int
@@ -23,6 +33,57 @@ class MedMentionExample(NamedTuple):
     entities: List[MedMentionEntity]
 
 
+class _EntityColumns(NamedTuple):
+    """
+    The entities of a single abstract, stored as parallel columns
+    rather than as a list of MedMentionEntity tuples.
+    """
+    starts: List[int]
+    ends: List[int]
+    mention_texts: Tuple[str, ...]
+    mention_types: List[str]
+    umls_ids: Tuple[str, ...]
+
+
+def _parse_example(lines: List[str]) -> Tuple[str, str, str, _EntityColumns]:
+    """
+    Parses the text lines of a single MedMention abstract into its pubmed id,
+    title, abstract and entity columns. See ``process_example`` for the format.
+    """
+    pubmed_id, _, rest = lines[0].partition("|")
+    title = rest.partition("|")[2].strip()
+    # Interned so that looking it up in the pmid splits is a pointer comparison.
+    pubmed_id = sys.intern(pubmed_id.strip())
+    abstract = lines[1].partition("|")[2].partition("|")[2].strip()
+
+    if len(lines) == 2:
+        return pubmed_id, title, abstract, _EntityColumns([], [], (), [], ())
+
+    # Split every entity line up front and transpose the rows into columns,
+    # so that the int conversion runs as a C level map over the whole
+    # abstract, rather than per line in python.
+    _, starts, ends, mentions, mention_types, umls_ids = zip(*[line.split("\t", 5) for line in lines[2:]])
+    entities = _EntityColumns(list(map(int, starts)), list(map(int, ends)), mentions,
+                              [mention_type.partition(",")[0] for mention_type in mention_types],
+                              tuple(umls_id.rstrip() for umls_id in umls_ids))
+    return pubmed_id, title, abstract, entities
+
+
+def _build_example(pubmed_id: str, title: str, abstract: str, entities: _EntityColumns) -> MedMentionExample:
+    # _make builds the entities with tuple.__new__ directly, skipping the
+    # argument handling of the generated MedMentionEntity constructor.
+    return MedMentionExample(title, abstract, title + " " + abstract, pubmed_id,
+                             list(map(MedMentionEntity._make, zip(*entities))))
+
+
+def _spacy_format_entities(entities: _EntityColumns,
+                           label_function: Optional[Callable[[str], str]] = None) -> List[Tuple[int, int, str]]:
+    mention_types: Iterable[str] = entities.mention_types
+    if label_function is not None:
+        mention_types = map(label_function, mention_types)
+    return list(zip(entities.starts, entities.ends, mention_types))
+
+
 def process_example(lines: List[str]) -> MedMentionExample:
     """
     Processes the text lines of a file corresponding to a single MedMention abstract,
@@ -33,113 +94,184 @@ def process_example(lines: List[str]) -> MedMentionExample:
     PMID TAB StartIndex TAB EndIndex TAB MentionTextSegment TAB SemanticTypeID TAB EntityID
     ...
     """
-    pubmed_id, _, title = [x.strip() for x in lines[0].split("|", maxsplit=2)]
-    _, _, abstract = [x.strip() for x in lines[1].split("|", maxsplit=2)]
-
-    entities = []
-    for entity_line in lines[2:]:
-        _, start, end, mention, mention_type, umls_id = entity_line.split("\t")
-        mention_type = mention_type.split(",")[0]
-        entities.append(MedMentionEntity(int(start), int(end),
-                                         mention, mention_type, umls_id))
-    return MedMentionExample(title, abstract, title + " " + abstract, pubmed_id, entities)
+    return _build_example(*_parse_example(lines))
 
-def med_mentions_example_iterator(filename: str) -> Iterator[MedMentionExample]:
+def _abstract_lines(text: str) -> Iterator[List[str]]:
+    """
+    Iterates over the text of a Med Mentions file, yielding the lines of each abstract.
+    """
+    # Abstracts are separated by blank lines, so split the whole file into
+    # abstracts with a single call, rather than looping over every line in python.
+    blocks = _BLANK_LINES.split(text)
+    del text
+    # Hand the blocks out from the end of the reversed list, so that nothing but the
+    # consumer holds on to each one. When they are parsed serially, the text of each
+    # abstract is then freed once it has been parsed, not when the file is done.
+    blocks.reverse()
+    while blocks:
+        # Line endings are already normalised to "\n", so only the ends of each
+        # block, and the ends of the fields at the ends of lines, need stripping.
+        block = blocks.pop().strip()
+        if block:
+            yield block.split("\n")
+
+def _map_abstracts(function: Callable[[List[str]], T],
+                   text: str,
+                   n_jobs: int = 1) -> Iterator[T]:
+    """
+    Applies ``function`` to the lines of each abstract in the text of a Med Mentions file.
+    Abstracts are independent of each other, so with ``n_jobs`` > 1 they are parsed
+    across a pool of worker processes, still being yielded in file order.
     """
-    Iterates over a Med Mentions file, yielding examples.
+    abstracts = _abstract_lines(text)
+    del text
+    if n_jobs == 1:
+        yield from map(function, abstracts)
+    else:
+        # Pool.imap's task handler drains ``abstracts`` as fast as it can, so here the
+        # blocks are all queued for the workers up front, rather than freed one at a time.
+        with Pool(processes=n_jobs) as pool:
+            yield from pool.imap(function, abstracts, chunksize=64)
+
+def med_mentions_example_iterator(filename: str, n_jobs: int = 1) -> Iterator[MedMentionExample]:
+    """
+    Iterates over a Med Mentions file, yielding examples. Abstracts
+    are parsed using ``n_jobs`` processes.
     """
     with open(filename, "r") as med_mentions_file:
-        lines = []
-        for line in med_mentions_file:
-            line = line.strip()
-            if line:
-                lines.append(line)
-            else:
-                yield process_example(lines)
-                lines = []
-        # Pick up stragglers
-        if lines:
-            yield process_example(lines)
+        examples = _map_abstracts(process_example, med_mentions_file.read(), n_jobs)
+    yield from examples
 
-def read_med_mentions(filename: str):
+def read_med_mentions(filename: str, n_jobs: int = 1):
     """
     Reads in the MedMentions dataset into Spacy's
-    NER format.
+    NER format, parsing abstracts using ``n_jobs`` processes.
     """
     examples = []
-    for example in med_mentions_example_iterator(filename):
-        spacy_format_entities = [(x.start, x.end, x.mention_type) for x in example.entities]
-        examples.append((example.text, {"entities": spacy_format_entities}))
+    with open(filename, "r") as med_mentions_file:
+        abstracts = _map_abstracts(_parse_example, med_mentions_file.read(), n_jobs)
+    # Going straight from the entity columns to spacy's format means
+    # no MedMentionEntity tuples need to be built.
+    for _, title, abstract, entities in abstracts:
+        examples.append((title + " " + abstract, {"entities": _spacy_format_entities(entities)}))
 
     return examples
 
 
-def read_full_med_mentions(directory_path: str,
-                           label_mapping: Dict[str, str] = None,
-                           span_only: bool = False,
-                           spacy_format: bool = True):
+def _read_pmids(text: str) -> Set[str]:
+    """
+    Reads the text of a file of whitespace separated pmids into a set.
+    """
+    return set(map(sys.intern, text.split()))
 
-    def _cleanup_dir(dir_path: str):
-        if os.path.exists(dir_path):
-            shutil.rmtree(dir_path)
 
-    resolved_directory_path = cached_path(directory_path)
-    if "tar.gz" in directory_path:
-        # Extract dataset to temp dir
-        tempdir = tempfile.mkdtemp()
-        print(f"extracting dataset directory {resolved_directory_path} to temp dir {tempdir}")
-        with tarfile.open(resolved_directory_path, 'r:gz') as archive:
-            archive.extractall(tempdir)
-        # Postpone cleanup until exit in case the unarchived
-        # contents are needed outside this function.
-        atexit.register(_cleanup_dir, tempdir)
+def _read_archive(archive_path: str, names: List[str]) -> Dict[str, str]:
+    """
+    Reads the text of the members of a tar.gz archive with the given file names,
+    regardless of the directory they are in. The archive is streamed, so it is only
+    decompressed once, and nothing is extracted to disk.
+    """
+    contents = {}
+    with tarfile.open(archive_path, "r|gz", bufsize=_READ_BUFFER_SIZE) as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            member_file = archive.extractfile(member) if name in names else None
+            if member_file is None:
+                continue
+            text = member_file.read().decode("utf-8")
+            # Normalise line endings, as reading the file in text mode would.
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            contents[name] = text
+    return contents
+
 
-        resolved_directory_path = tempdir
+def _span_label(_: str) -> str:
+    return "ENTITY"
 
 
+def read_full_med_mentions(directory_path: str,
+                           label_mapping: Dict[str, str] = None,
+                           span_only: bool = False,
+                           spacy_format: bool = True,
+                           n_jobs: int = 1):
+
     expected_names = ["corpus_pubtator.txt",
                       "corpus_pubtator_pmids_all.txt",
                       "corpus_pubtator_pmids_dev.txt",
                       "corpus_pubtator_pmids_test.txt",
                       "corpus_pubtator_pmids_trng.txt"]
 
-    corpus = os.path.join(resolved_directory_path, expected_names[0])
-    examples = med_mentions_example_iterator(corpus)
-
-    train_ids = {x.strip() for x in open(os.path.join(resolved_directory_path, expected_names[4]))}
-    dev_ids = {x.strip() for x in open(os.path.join(resolved_directory_path, expected_names[2]))}
-    test_ids = {x.strip() for x in open(os.path.join(resolved_directory_path, expected_names[3]))}
-
-    train_examples = []
-    dev_examples = []
-    test_examples = []
-
-    def label_function(label):
-        if span_only:
-            return "ENTITY"
-        if label_mapping is None:
-            return label
+    # The list of all pmids isn't needed, as it is just the union of the splits.
+    needed_names = [expected_names[0]] + expected_names[2:]
+    resolved_directory_path = cached_path(directory_path)
+    if "tar.gz" in directory_path:
+        # Read the members we need straight out of the archive in a single pass,
+        # rather than extracting the whole dataset to disk and reading it back in.
+        contents = _read_archive(resolved_directory_path, needed_names)
+    else:
+        contents = {}
+        for name in needed_names:
+            with open(os.path.join(resolved_directory_path, name)) as med_mentions_file:
+                contents[name] = med_mentions_file.read()
+
+    train_ids = _read_pmids(contents[expected_names[4]])
+    dev_ids = _read_pmids(contents[expected_names[2]])
+    test_ids = _read_pmids(contents[expected_names[3]])
+
+    train_examples: List = []
+    dev_examples: List = []
+    test_examples: List = []
+
+    # Map each pmid directly to the append method of the list its examples
+    # belong in, so each example only needs a single lookup to find its split,
+    # and no attribute lookup to add to it. Later updates win, so a pmid in
+    # several splits goes to train, then dev, then test.
+    split_map = dict.fromkeys(test_ids, test_examples.append)
+    split_map.update(dict.fromkeys(dev_ids, dev_examples.append))
+    split_map.update(dict.fromkeys(train_ids, train_examples.append))
+    # Only the map is needed from here on.
+    del train_ids, dev_ids, test_ids
+
+    # Choose how to label entities once, rather than re-checking the
+    # options for every entity. None means the mention type is used as is.
+    label_function: Optional[Callable[[str], str]] = None
+    if span_only:
+        label_function = _span_label
+    elif label_mapping is not None:
+        label_function = label_mapping.__getitem__
+
+    # The corpus text is handed over without keeping a reference to it here,
+    # so that it can be freed as soon as it has been split into abstracts.
+    abstracts = _map_abstracts(_parse_example, contents.pop(expected_names[0]), n_jobs)
+    del contents
+    for pubmed_id, title, abstract, entities in abstracts:
+        append = split_map.get(pubmed_id)
+        if append is None:
+            continue
+        if spacy_format:
+            spacy_format_entities = _spacy_format_entities(entities, label_function)
+            append((title + " " + abstract, {"entities": spacy_format_entities}))
         else:
-            return label_mapping[label]
-
-    for example in examples:
-        spacy_format_entities = [(x.start, x.end, label_function(x.mention_type)) for x in example.entities]
-        spacy_example = (example.text, {"entities": spacy_format_entities})
-        if example.pubmed_id in train_ids:
-            train_examples.append(spacy_example if spacy_format else example)
-
-        elif example.pubmed_id in dev_ids:
-            dev_examples.append(spacy_example if spacy_format else example)
-
-        elif example.pubmed_id in test_ids:
-            test_examples.append(spacy_example if spacy_format else example)
+            append(_build_example(pubmed_id, title, abstract, entities))
 
     return train_examples, dev_examples, test_examples
 
 
 SpacyNerExample = Tuple[str, Dict[str, List[Tuple[int, int, str]]]] # pylint: disable=invalid-name
 
-def _handle_sentence(examples: List[Tuple[str, str]]) -> SpacyNerExample:
+# Maps BIO tags to their entity types, e.g. "B-Taxon" -> "TAXON". There are only
+# a handful of distinct tags in a dataset, so this stays small.
+_TAG_CACHE: Dict[str, str] = {}
+
+def _entity_type(tag: str) -> str:
+    entity_type = _TAG_CACHE.get(tag)
+    if entity_type is None:
+        entity_type = tag[2:].upper()
+        _TAG_CACHE[tag] = entity_type
+    return entity_type
+
+def _handle_sentence(examples: List[List[str]]) -> SpacyNerExample:
     """
     Processes a single sentence by building it up as a space separated string
     with its corresponding typed entity spans.
@@ -148,32 +280,26 @@ def _handle_sentence(examples: List[Tuple[str, str]]) -> SpacyNerExample:
     current_index = 0
     in_entity = False
     entity_type: str = ""
-    sent = ""
     entities: List[Tuple[int, int, str]] = []
     for word, entity in examples:
-        sent += word
-        sent += " "
+        # A run of consecutive non 'O' tags is a single entity, so only the
+        # first tag of a run and the 'O' after it change anything.
         if entity != 'O':
-            if in_entity:
-                pass
-            else:
+            if not in_entity:
                 start_index = current_index
                 in_entity = True
-                entity_type = entity[2:].upper()
-        else:
-            if in_entity:
-                end_index = current_index - 1
-                entities.append((start_index, end_index, entity_type))
+                entity_type = _entity_type(entity)
+        elif in_entity:
+            end_index = current_index - 1
+            entities.append((start_index, end_index, entity_type))
             in_entity = False
-            entity_type = ""
-            start_index = -1
         current_index += (len(word) + 1)
     if in_entity:
         end_index = current_index - 1
         entities.append((start_index, end_index, entity_type))
 
-    # Remove last space.
-    sent = sent[:-1]
+    # Join the words once, rather than growing the sentence a word at a time.
+    sent = " ".join([word for word, _ in examples])
     return (sent, {'entities': entities})
 
 
@@ -201,20 +327,20 @@ def read_ner_from_tsv(filename: str) -> List[SpacyNerExample]:
         The BIO tagged NER examples.
     """
     spacy_format_data = []
-    examples: List[Tuple[str, str]] = []
-    for line in open(cached_path(filename)):
-        line = line.strip()
-        if line.startswith('-DOCSTART-'):
-            continue
-        # We have reached the end of a sentence.
-        if not line:
-            if not examples:
-                continue
-            spacy_format_data.append(_handle_sentence(examples))
-            examples = []
-        else:
-            word, entity = line.split("\t")
-            examples.append((word, entity))
+    examples: List[List[str]] = []
+    with open(cached_path(filename)) as tsv_file:
+        for line in tsv_file:
+            line = line.strip()
+            # We have reached the end of a sentence.
+            if not line:
+                if not examples:
+                    continue
+                spacy_format_data.append(_handle_sentence(examples))
+                examples = []
+            elif not line.startswith('-DOCSTART-'):
+                # _handle_sentence unpacks each line into its word and tag, so a
+                # line without exactly one tab still raises a ValueError.
+                examples.append(line.split("\t"))
     if examples:
         spacy_format_data.append(_handle_sentence(examples))
 
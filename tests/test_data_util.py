@@ -1,10 +1,12 @@
 # pylint: disable=no-self-use,invalid-name
 import os
 import unittest
+from unittest import mock
 import shutil
+import tarfile
 
 
-from scispacy.data_util import read_med_mentions, med_mentions_example_iterator
+from scispacy.data_util import read_med_mentions, med_mentions_example_iterator, read_full_med_mentions
 from scispacy.data_util import read_ner_from_tsv
 
 class TestDataUtil(unittest.TestCase):
@@ -34,6 +36,64 @@ class TestDataUtil(unittest.TestCase):
         examples = read_med_mentions(self.med_mentions)
         assert len(examples) == 3
 
+    def test_read_med_mentions_with_whitespace_padded_lines(self):
+        with open(self.med_mentions) as med_mentions_file:
+            lines = med_mentions_file.read().split("\n")
+        # Blank lines become whitespace only, and every other line gets trailing whitespace.
+        padded_path = os.path.join(self.TEST_DIR, "padded_med_mentions.txt")
+        with open(padded_path, "w") as padded_file:
+            padded_file.write("\n".join(line + " \t" if line else " " for line in lines))
+
+        assert read_med_mentions(padded_path) == read_med_mentions(self.med_mentions)
+        padded_examples = list(med_mentions_example_iterator(padded_path))
+        assert padded_examples == list(med_mentions_example_iterator(self.med_mentions))
+
+    def test_read_med_mentions_in_parallel(self):
+        assert read_med_mentions(self.med_mentions, n_jobs=2) == read_med_mentions(self.med_mentions)
+        parallel_examples = list(med_mentions_example_iterator(self.med_mentions, n_jobs=2))
+        assert parallel_examples == list(med_mentions_example_iterator(self.med_mentions))
+
+    def _write_med_mentions_archive(self):
+        splits = {"corpus_pubtator_pmids_all.txt": ["25763772", "25847295", "26316050"],
+                  "corpus_pubtator_pmids_trng.txt": ["25763772", "25847295"],
+                  "corpus_pubtator_pmids_dev.txt": ["26316050"],
+                  "corpus_pubtator_pmids_test.txt": []}
+        archive_path = os.path.join(self.TEST_DIR, "med_mentions.tar.gz")
+        with tarfile.open(archive_path, "w:gz") as archive:
+            # The corpus goes first, as it does when the dataset is archived with `tar czf`.
+            archive.add(self.med_mentions, arcname="data/corpus_pubtator.txt")
+            for name, pmids in splits.items():
+                pmid_path = os.path.join(self.TEST_DIR, name)
+                with open(pmid_path, "w") as pmid_file:
+                    pmid_file.write("".join(pmid + "\n" for pmid in pmids))
+                archive.add(pmid_path, arcname="data/" + name)
+        return archive_path
+
+    def test_read_full_med_mentions_from_archive(self):
+        archive_path = self._write_med_mentions_archive()
+
+        train, dev, test = read_full_med_mentions(archive_path)
+        assert len(train) == 2
+        assert len(dev) == 1
+        assert not test
+        assert train == read_med_mentions(self.med_mentions)[:2]
+
+        train, dev, test = read_full_med_mentions(archive_path, spacy_format=False)
+        assert [x.pubmed_id for x in train] == ["25763772", "25847295"]
+        assert dev[0].pubmed_id == "26316050"
+
+        _, dev, _ = read_full_med_mentions(archive_path, span_only=True)
+        assert {label for _, _, label in dev[0][1]["entities"]} == {"ENTITY"}
+
+    def test_read_full_med_mentions_reads_archive_in_one_pass(self):
+        archive_path = self._write_med_mentions_archive()
+        with mock.patch.object(tarfile, "open", wraps=tarfile.open) as open_archive:
+            train, dev, test = read_full_med_mentions(archive_path)
+        assert (len(train), len(dev), len(test)) == (2, 1, 0)
+        open_archive.assert_called_once()
+        # Stream mode only ever reads forwards, so the archive is decompressed once.
+        assert open_archive.call_args[0][1] == "r|gz"
+
 
     def test_read_ner_from_tsv(self):
 
@@ -51,3 +111,33 @@ class TestDataUtil(unittest.TestCase):
         example = data[3]
         assert example[0] == 'Little is known about genetic factors affecting intraocular pressure ( IOP ) in mice and other mammals .'
         assert example[1] ==  {'entities': [(22, 29, 'SO'), (80, 84, 'TAXON'), (95, 102, 'TAXON')]}
+
+    def test_read_ner_from_tsv_entities_do_not_span_sentences(self):
+        tsv_path = os.path.join(self.TEST_DIR, "ner.tsv")
+        with open(tsv_path, "w") as tsv_file:
+            tsv_file.write("-DOCSTART-\tO\n\n"
+                           "Mice\tB-Taxon\nhave\tO\nIOP\tB-SO\nlevels\tI-SO\n\n"
+                           "Rats\tB-Taxon\ntoo\tO\n")
+
+        data = read_ner_from_tsv(tsv_path)
+        assert data == [('Mice have IOP levels', {'entities': [(0, 4, 'TAXON'), (10, 20, 'SO')]}),
+                        ('Rats too', {'entities': [(0, 4, 'TAXON')]})]
+
+    def test_read_ner_from_tsv_rejects_lines_without_one_tab(self):
+        tsv_path = os.path.join(self.TEST_DIR, "malformed.tsv")
+        for malformed in ["a\tb\tc\nd\nRats\tO\n", "Mice\tO\nhave\t\nIOP\tB-SO\n"]:
+            with open(tsv_path, "w") as tsv_file:
+                tsv_file.write(malformed)
+            with self.assertRaises(ValueError):
+                read_ner_from_tsv(tsv_path)
+
+    def test_read_ner_from_tsv_strips_whitespace(self):
+        tsv_path = os.path.join(self.TEST_DIR, "padded.tsv")
+        with open(tsv_path, "w") as tsv_file:
+            tsv_file.write(" Mice\tB-Taxon \nhave\tO \nIOP\tB-SO\t\n \n"
+                           "Rats\tB-Taxon\ntoo\tO\n\t\nMice\tO\n")
+
+        data = read_ner_from_tsv(tsv_path)
+        assert data == [('Mice have IOP', {'entities': [(0, 4, 'TAXON'), (10, 13, 'SO')]}),
+                        ('Rats too', {'entities': [(0, 4, 'TAXON')]}),
+                        ('Mice', {'entities': []})]